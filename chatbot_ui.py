@@ -1,13 +1,154 @@
 # chatbot_ui.py
 # This file implements a Chatbot UI for interacting with a Red Hat proposal agent using Gradio.
 # It allows users to ask questions about Red Hat proposals and receive responses from the agent.
+import asyncio
 import gradio
+import hashlib
+import httpx
+import json
 import logging
+import numpy as np
 import os
+import redis
+import socket
 import sys
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from llama_stack_client import LlamaStackClient, Agent
+from llama_stack_client import APIStatusError, LlamaStackClient
 from constants import LOG_LEVELS
+from semantic_cache import LSHSemanticCache, normalize
+
+# Marker published once a turn has no more partial responses
+_TURN_DONE = object()
+
+# Maximum number of embeddings kept by the exact-match embedding cache
+EMBEDDING_CACHE_SIZE = 4096
+
+# Maximum number of RAG results kept by the prefetch cache
+PREFETCH_CACHE_SIZE = 128
+
+# Maximum number of questions whose follow-up questions are remembered to predict the next question
+FOLLOW_UP_CACHE_SIZE = 1024
+
+# Maximum number of Gradio sessions bound to an agent session, the least recent ones start a new agent session
+SESSION_CACHE_SIZE = 1024
+
+# Toolgroup of the proposal tools, available in every turn
+PROPOSAL_TOOLGROUP = "ocp::proposal"
+
+# Redis key of the agent state shared by every replica
+AGENT_STATE_KEY = "agent:orquestrator"
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configuration of the agentic system, read once from the environment at import
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Immutable configuration of the agentic system."""
+
+    root_log_level: str
+    app_log_level: str
+    model_id: str
+    base_url_llama_stack: str
+    # sampling_params will later be used to pass the parameters to Llama Stack Agents/Inference APIs
+    sampling_params: dict
+    # the Boolean 'stream' parameter will later be passed to Llama Stack Agents/Inference APIs
+    stream: bool
+    max_infer_iters: int
+    vector_db_id: str
+    embedding_model_id: str
+    similarity_threshold: float
+    semantic_cache_dir: str
+    semantic_cache_capacity: int
+    semantic_cache_ttl: float
+    concurrency_limit: int
+    agent_state_file: str
+    agent_state_redis_url: str | None
+    prefetch_top_k: int
+    prefetch_threshold: float
+
+    # Function to read the configuration from the environment variables
+    @classmethod
+    def from_env(cls) -> "Config":
+        """Build the configuration from the environment variables."""
+        temperature = float(os.getenv("TEMPERATURE", 0.95))
+        if temperature > 0.0:
+            top_p = float(os.getenv("TOP_P", 0.95))
+            strategy = {"type": "top_p", "temperature": temperature, "top_p": top_p}
+        else:
+            strategy = {"type": "greedy"}
+
+        return cls(
+            root_log_level=os.getenv("ROOT_LOG_LEVEL", "INFO"),
+            app_log_level=os.getenv("APP_LOG_LEVEL", "INFO"),
+            model_id=os.getenv("MODEL_ID", "granite-3-3-8b-instruct"),
+            base_url_llama_stack=os.getenv("LLAMA_STACK_BASE_URL", "http://localhost:8321"),
+            sampling_params={
+                "strategy": strategy,
+                "max_tokens": int(os.getenv("MAX_TOKENS", 4096)),
+            },
+            # any value non equal to 'False' will be considered as 'True'
+            stream=(os.getenv("STREAM", "True") != "False"),
+            max_infer_iters=int(os.getenv("MAX_INFER_ITERS", 1)),
+            vector_db_id=os.getenv("VECTOR_DB_ID_OCP", "ocp_rh_vector_db"),
+            # Semantic cache to answer repeated questions without a new agent turn
+            embedding_model_id=os.getenv("EMBEDDING_MODEL_ID", "all-MiniLM-L6-v2"),
+            similarity_threshold=float(os.getenv("SIMILARITY_THRESHOLD", 0.95)),
+            # an empty SEMANTIC_CACHE_DIR keeps the cache in memory only
+            semantic_cache_dir=os.getenv("SEMANTIC_CACHE_DIR", "./.semantic_cache"),
+            semantic_cache_capacity=int(os.getenv("SEMANTIC_CACHE_CAPACITY", 65536)),
+            semantic_cache_ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 86400)),
+            # Number of questions answered concurrently, each one in its own agent session
+            concurrency_limit=int(os.getenv("CONCURRENCY_LIMIT", 8)),
+            # Agent state persisted across restarts, in Redis when several replicas share it
+            agent_state_file=os.getenv("AGENT_STATE_FILE", "./.agent_state.json"),
+            agent_state_redis_url=os.getenv("AGENT_STATE_REDIS_URL"),
+            # Prefetch of the RAG results of the likely follow-up questions
+            prefetch_top_k=int(os.getenv("PREFETCH_TOP_K", 3)),
+            prefetch_threshold=float(os.getenv("PREFETCH_THRESHOLD", 0.85)),
+        )
+
+CONFIG = Config.from_env()
+
+# Function to flatten the content returned by the RAG tool into text
+def _content_text(content) -> str:
+    """Return the text of a string or of a list of content items."""
+    if isinstance(content, str):
+        return content
+    return "".join(getattr(item, "text", "") for item in content)
+
+# Function to find the previous question of a conversation
+def _previous_question(history: list):
+    """Return the last user message of the history, or None for the first question."""
+    return next(
+        (message["content"] for message in reversed(history or [])
+         if message.get("role") == "user" and isinstance(message.get("content"), str)),
+        None,
+    )
+
+# Function to build the context a question is cached in
+def _cache_context(history: list) -> str:
+    """Return the digest of the previous question of the conversation, empty for its first question."""
+    previous = _previous_question(history)
+    return "" if previous is None else hashlib.blake2b(previous.encode(), digest_size=16).hexdigest()
+
+# Function to build the document that replays the exchanges answered from the semantic cache
+def _replay_document(exchanges: list) -> dict:
+    """Return a turn document with the questions and cached answers the agent session has not seen."""
+    text = "\n\n".join(f"Question: {question}\nAnswer: {answer}" for question, answer in exchanges)
+    return {"content": f"Earlier exchanges of this conversation:\n\n{text}", "mime_type": "text/plain"}
+
+# Function to collect the items already waiting in a queue
+async def _collect_batch(queue: asyncio.Queue, max_size: int) -> list:
+    """Wait for one item, then take up to max_size items that are already queued without waiting for more."""
+    batch = [await queue.get()]
+    while len(batch) < max_size and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
 
 # Class to create an agentic system for interacting with Llama Stack Agents
 #I am a Red Hat associate and I need to know if AWS is the infrastructure recommend to deploy Openshift in the cloud
@@ -18,103 +159,408 @@ class AgenticProposalRH:
     """Agentic System for interacting with Llama Stack Agents."""
 
     # Function to initialize the agentic system
-    def __init__(self):
+    def __init__(self, config: Config = CONFIG):
         sys.path.append('..')
-        # Load environment variables from .env file
-        load_dotenv()
-
-        root_log_level = os.getenv("ROOT_LOG_LEVEL", "INFO")
-        app_log_level = os.getenv("APP_LOG_LEVEL", "INFO")
+        self.config = config
 
         # Set logging levels
         logging.getLogger("httpx").setLevel(logging.WARNING)
-        logging.basicConfig(level=LOG_LEVELS[root_log_level], format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+        logging.basicConfig(level=LOG_LEVELS[config.root_log_level], format='%(asctime)s - %(levelname)s - %(message)s', force=True)
 
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(LOG_LEVELS[app_log_level])
+        self.logger.setLevel(LOG_LEVELS[config.app_log_level])
 
-        self.model_id = os.getenv("MODEL_ID", "granite-3-3-8b-instruct")
-        base_url_llama_stack = os.getenv("LLAMA_STACK_BASE_URL", "http://localhost:8321")
-
-        # Initialize the Llama Stack client
+        # Initialize the Llama Stack client on a pooled connection, with TCP_NODELAY for the small stream chunks
+        # httpx only negotiates HTTP/2 over TLS (ALPN), an http:// base URL keeps using HTTP/1.1 keep-alive connections
+        http_transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+            socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+        )
         self.client = LlamaStackClient(
-            base_url=base_url_llama_stack,
+            base_url=config.base_url_llama_stack,
             timeout=120.0,
+            # follow_redirects keeps the default of the SDK client
+            http_client=httpx.Client(transport=http_transport, timeout=120.0, follow_redirects=True),
         )
-        self.logger.info(f"Connected to Llama Stack server at {base_url_llama_stack}")
+        self.logger.info(f"Connected to Llama Stack server at {config.base_url_llama_stack}")
 
-        temperature = float(os.getenv("TEMPERATURE", 0.95))
-        if temperature > 0.0:
-            top_p = float(os.getenv("TOP_P", 0.95))
-            strategy = {"type": "top_p", "temperature": temperature, "top_p": top_p}
-        else:
-            strategy = {"type": "greedy"}
+        self.logger.info(f"Inference Parameters:\n\tModel: {config.model_id}\n\tSampling Parameters: {config.sampling_params}\n\tstream: {config.stream}\n\tmax_infer_iters: {config.max_infer_iters}")
 
-        max_tokens = int(os.getenv("MAX_TOKENS", 4096))
+        # Semantic cache to answer repeated questions without a new agent turn
+        self.semantic_cache = LSHSemanticCache(
+            threshold=config.similarity_threshold,
+            path=config.semantic_cache_dir or None,
+            capacity=config.semantic_cache_capacity,
+            ttl=config.semantic_cache_ttl,
+            model_id=config.embedding_model_id,
+        )
+        self.logger.info(f"Semantic cache enabled with embedding model: {config.embedding_model_id}")
 
-        # sampling_params will later be used to pass the parameters to Llama Stack Agents/Inference APIs
-        self.sampling_params = {
-            "strategy": strategy,
-            "max_tokens": max_tokens,
+        # Handlers of the stream events, indexed by event type
+        self.event_handlers = {
+            "step_progress": self._on_step_progress,
+            "turn_complete": self._on_turn_complete,
         }
 
-        stream_env = os.getenv("STREAM", "True")
-        
-        # the Boolean 'stream' parameter will later be passed to Llama Stack Agents/Inference APIs
-        # any value non equal to 'False' will be considered as 'True'
-        self.stream = (stream_env != "False")
+        # Exact-match LRU cache of embeddings keyed by the digest of the text
+        self.embedding_cache = OrderedDict()
+        self.embedding_cache_lock = threading.Lock()
 
-        self.max_infer_iters = int(os.getenv("MAX_INFER_ITERS", 1))
+        # Agent turns run in their own thread pool, so they do not hold the threads of the embedding and lookup calls
+        self.turn_executor = ThreadPoolExecutor(max_workers=config.concurrency_limit, thread_name_prefix="agent-turn")
+        # Agent session of each Gradio session, so concurrent conversations do not share a turn history, as a bounded LRU
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.pending_lookups = None
+        self.lookup_batcher = None
+        self.background_tasks = set()
 
-        self.logger.info(f"Inference Parameters:\n\tModel: {self.model_id}\n\tSampling Parameters: {self.sampling_params}\n\tstream: {self.stream}\n\tmax_infer_iters: {self.max_infer_iters}")
+        # RAG results prefetched for the likely follow-up questions, as an LRU keyed by question digest
+        self.prefetched = OrderedDict()
+        # Questions asked after each question, as an LRU keyed by the digest of the earlier question
+        self.follow_ups = OrderedDict()
+        # Exchanges answered from the semantic cache that the agent session has not seen yet, per Gradio session
+        self.replays = OrderedDict()
+
+    # Function to compute the normalized embedding of a text
+    def _embed(self, text: str):
+        """Embed a text with the embedding model and L2-normalize it, reusing the embedding of identical texts."""
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self.embedding_cache_lock:
+            embedding = self.embedding_cache.get(key)
+            if embedding is not None:
+                self.embedding_cache.move_to_end(key)
+                return embedding
+
+        response = self.client.inference.embeddings(
+            model_id=self.config.embedding_model_id,
+            contents=[text],
+        )
+        embedding = normalize(response.embeddings[0])
+        # The same array is shared by every hit, so it is made read-only
+        embedding.setflags(write=False)
+
+        with self.embedding_cache_lock:
+            self.embedding_cache[key] = embedding
+            if len(self.embedding_cache) > EMBEDDING_CACHE_SIZE:
+                self.embedding_cache.popitem(last=False)
+        return embedding
+
+    # Function to load the agent ID persisted by a previous start
+    def _load_agent_state(self):
+        """Load the persisted agent state from Redis or from the state file, if any."""
+        try:
+            if self.config.agent_state_redis_url:
+                state = redis.Redis.from_url(self.config.agent_state_redis_url).get(AGENT_STATE_KEY)
+            elif os.path.exists(self.config.agent_state_file):
+                with open(self.config.agent_state_file) as f:
+                    state = f.read()
+            else:
+                return None
+            return json.loads(state) if state else None
+        except Exception as e:
+            self.logger.warning(f"Agent state could not be loaded, a new agent will be created: {e}")
+            return None
+
+    # Function to persist the agent ID for the next start
+    def _save_agent_state(self, state: dict):
+        """Save the agent state to Redis or to the state file, the next start creates a new agent if it fails."""
+        try:
+            if self.config.agent_state_redis_url:
+                redis.Redis.from_url(self.config.agent_state_redis_url).set(AGENT_STATE_KEY, json.dumps(state))
+            else:
+                with open(self.config.agent_state_file, "w") as f:
+                    json.dump(state, f)
+        except Exception as e:
+            self.logger.warning(f"Agent state could not be saved: {e}")
+
+    # Function to validate the vector DB and warm its index before serving
+    def _warm_vector_db(self, vector_db_id: str):
+        """Check that the vector DB exists and run a warmup query against it."""
+        try:
+            self.client.vector_dbs.retrieve(vector_db_id)
+            self.client.tool_runtime.rag_tool.query(content="warmup", vector_db_ids=[vector_db_id])
+        except Exception as e:
+            self.logger.error(f"Vector DB {vector_db_id} is not available: {e}")
+            raise
+        self.logger.info(f"Vector DB {vector_db_id} is available and warmed up")
+
+    # Function to validate the embedding model used by the semantic cache
+    def _check_embedding_model(self):
+        """Embed a warmup text, disabling the semantic cache when the embedding model is not available."""
+        if self.semantic_cache is None:
+            return
+        try:
+            self._embed("warmup")
+        except Exception as e:
+            self.logger.error(f"Embedding model {self.config.embedding_model_id} is not available, semantic cache disabled: {e}")
+            self.semantic_cache = None
+            return
+        self.logger.info(f"Embedding model {self.config.embedding_model_id} is available")
 
     # Function to create the agent with the specified model and tools
     def create_agent(self):
-        """Create an agent with the specified model and tools."""
+        """Create an agent with the specified model and tools, or reuse the one of a previous start."""
 
-        vector_db_id = os.getenv("VECTOR_DB_ID_OCP", "ocp_rh_vector_db")
+        vector_db_id = self.config.vector_db_id
 
         self.logger.info(f"Vector DB ID for OCP: {vector_db_id}")
 
-        # Create the agent using the Agent class
-        self.agent = Agent(
-            client=self.client,
-            model=self.model_id,
-            instructions=(
+        self._warm_vector_db(vector_db_id)
+        self._check_embedding_model()
+
+        agent_config = {
+            "model": self.config.model_id,
+            "instructions": (
                 "You are a helpful assistant."
                 "You can use the tools available to answer user questions."
             ),
-            tools=[
-                "ocp::proposal",
+            "toolgroups": [
+                PROPOSAL_TOOLGROUP,
                 {
                     "name": "builtin::rag/knowledge_search",
                     "args": {"vector_db_ids": [vector_db_id]},
                 }
             ],
-            input_shields=[],
-            output_shields=[],
-            max_infer_iters=self.max_infer_iters,
-            sampling_params=self.sampling_params,
-        )
-        self.agent_id = self.agent.agent_id
+            "input_shields": [],
+            "output_shields": [],
+            "max_infer_iters": self.config.max_infer_iters,
+            "sampling_params": self.config.sampling_params,
+        }
+        # Any change of the agent configuration creates a new agent, the server keeps the configuration of the old one
+        config_hash = hashlib.sha256(json.dumps(agent_config, sort_keys=True).encode()).hexdigest()
+
+        # Reuse the agent of a previous start when it was created with the same configuration
+        self.agent_id = None
+        state = self._load_agent_state()
+        if state and state.get("config_hash") == config_hash:
+            try:
+                self.client.agents.retrieve(state["agent_id"])
+                self.agent_id = state["agent_id"]
+                self.logger.info(f"Agent reused with ID: {self.agent_id}")
+            except APIStatusError as e:
+                # Llama Stack 0.2.x servers answer an unknown agent ID with a 400, newer ones with a 404
+                if e.status_code not in (400, 404):
+                    raise
+                self.logger.info(f"Agent {state['agent_id']} no longer exists, creating a new one")
+
+        if self.agent_id is None:
+            self.agent_id = self.client.agents.create(agent_config=agent_config).agent_id
+            self.logger.info(f"Agent created with ID: {self.agent_id}")
+            self._save_agent_state({"agent_id": self.agent_id, "config_hash": config_hash})
+
+    # Function to get the agent session of a Gradio session, creating it on its first question
+    def _session_for(self, session_hash: str) -> str:
+        """Return the agent session ID bound to the Gradio session."""
+        with self.sessions_lock:
+            session_id = self.sessions.get(session_hash)
+            if session_id is not None:
+                self.sessions.move_to_end(session_hash)
+                return session_id
 
-        # Create a session that will be used to ask the agent a sequence of questions
-        self.session_id = self.agent.create_session(session_name="agent1")
-        self.history_formatted = []
-        self.logger.info(f"Agent created with ID: {self.agent_id} and session ID: {self.session_id}")
+        # The session is created outside the lock, so other conversations are not blocked by the roundtrip
+        session_id = self.client.agents.session.create(
+            agent_id=self.agent_id,
+            session_name=f"gradio-{session_hash}",
+        ).session_id
+        self.logger.info(f"Session {session_id} created for Gradio session {session_hash}")
+        with self.sessions_lock:
+            session_id = self.sessions.setdefault(session_hash, session_id)
+            if len(self.sessions) > SESSION_CACHE_SIZE:
+                self.sessions.popitem(last=False)
+            return session_id
 
     # Function to make questions to the agent and yield responses
-    def make_questions(self, question: str, history: list):
-        
-        self.logger.debug(f"{self.session_id} | Question: {question}")
+    async def make_questions(self, question: str, history: list, request: gradio.Request = None):
+
+        session_hash = getattr(request, "session_hash", None) or "default"
+        self.logger.debug(f"{session_hash} | Question: {question}")
+
+        # Answer from the semantic cache when an equivalent question was already made after the same previous question.
+        # The cache is optional: when the embedding or the lookup fails the question goes to the agent
+        embedding, cache_context = None, _cache_context(history)
+        if self.semantic_cache is not None:
+            try:
+                embedding = await asyncio.to_thread(self._embed, question)
+                cached_response = await self._lookup_cached(embedding, cache_context)
+            except Exception as e:
+                self.logger.warning(f"{session_hash} | Semantic cache unavailable: {e}")
+                embedding, cached_response = None, None
+            if cached_response is not None:
+                self.logger.debug(f"{session_hash} | Response served from semantic cache")
+                # A cached answer does not reach the agent, so it is replayed in the next turn of the conversation
+                self.replays.setdefault(session_hash, []).append((question, cached_response))
+                self.replays.move_to_end(session_hash)
+                if len(self.replays) > SESSION_CACHE_SIZE:
+                    self.replays.popitem(last=False)
+                yield cached_response
+                return
+
+        documents = []
+        replayed = self.replays.pop(session_hash, None)
+        if replayed:
+            documents.append(_replay_document(replayed))
+
+        # Attach the context prefetched for a similar question, prefetched contexts are keyed by the question alone
+        # because a retrieval does not depend on the conversation
+        if embedding is not None:
+            context = self._lookup_prefetched(embedding)
+            if context is not None:
+                self.logger.debug(f"{session_hash} | Using prefetched context")
+                documents.append({"content": context, "mime_type": "text/plain"})
 
-        # Append the question to the history
-        self.history_formatted.append(question)
+        # The agent session is only created once a question is not answered from the cache
+        session_id = await asyncio.to_thread(self._session_for, session_hash)
+
+        # Run the turn right away in the turn thread pool and yield the partial responses it publishes.
+        # When the user stops the answer or disconnects, the event tells the turn to release its thread
+        loop = asyncio.get_running_loop()
+        partial_responses = asyncio.Queue()
+        cancelled = threading.Event()
+        loop.run_in_executor(
+            self.turn_executor, self._publish_turn,
+            loop, session_id, question, embedding, cache_context, documents, partial_responses, cancelled,
+        )
+        try:
+            while True:
+                partial_response = await partial_responses.get()
+                if partial_response is _TURN_DONE:
+                    break
+                if isinstance(partial_response, Exception):
+                    raise partial_response
+                yield partial_response
+        finally:
+            cancelled.set()
+
+        # Prefetch the context of the likely follow-up questions while the user reads the answer
+        if embedding is not None:
+            task = asyncio.create_task(self._prefetch_related(question, embedding, history))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    # Function to find the context prefetched for a question similar to the given one
+    def _lookup_prefetched(self, embedding):
+        """Return the prefetched RAG context of the most similar question, or None."""
+        if not self.prefetched:
+            return None
+        keys = list(self.prefetched)
+        scores = np.stack([self.prefetched[key][0] for key in keys]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.config.prefetch_threshold:
+            return None
+        self.prefetched.move_to_end(keys[best])
+        return self.prefetched[keys[best]][1]
+
+    # Function to remember that a question was asked right after the previous question of its conversation
+    async def _record_follow_up(self, question: str, history: list):
+        """Count the question as a follow-up of the previous question of the conversation."""
+        previous = _previous_question(history)
+        if previous is None or previous == question:
+            return
+        # The embedding of the previous question comes from the exact-match embedding cache
+        previous_embedding = await asyncio.to_thread(self._embed, previous)
+        key = hashlib.blake2b(previous.encode(), digest_size=16).digest()
+        if key not in self.follow_ups:
+            self.follow_ups[key] = (previous_embedding, Counter())
+        self.follow_ups[key][1][question] += 1
+        self.follow_ups.move_to_end(key)
+        if len(self.follow_ups) > FOLLOW_UP_CACHE_SIZE:
+            self.follow_ups.popitem(last=False)
+
+    # Function to prefetch the RAG results of the questions that usually follow a question
+    async def _prefetch_related(self, question: str, embedding, history: list):
+        """Query the vector DB for the top-K questions asked after similar questions and keep the results."""
+        try:
+            await self._record_follow_up(question, history)
+            if not self.follow_ups:
+                return
+            keys = list(self.follow_ups)
+            scores = np.stack([self.follow_ups[key][0] for key in keys]) @ embedding
+            candidates = Counter()
+            for index in np.flatnonzero(scores >= self.config.prefetch_threshold):
+                candidates.update(self.follow_ups[keys[index]][1])
+            candidates.pop(question, None)
+
+            for follow_up, _ in candidates.most_common(self.config.prefetch_top_k):
+                key = hashlib.blake2b(follow_up.encode(), digest_size=16).digest()
+                if key in self.prefetched:
+                    self.prefetched.move_to_end(key)
+                    continue
+                follow_up_embedding = await asyncio.to_thread(self._embed, follow_up)
+                result = await asyncio.to_thread(
+                    self.client.tool_runtime.rag_tool.query,
+                    content=follow_up,
+                    vector_db_ids=[self.config.vector_db_id],
+                )
+                self.prefetched[key] = (follow_up_embedding, _content_text(result.content))
+                if len(self.prefetched) > PREFETCH_CACHE_SIZE:
+                    self.prefetched.popitem(last=False)
+        except Exception as e:
+            self.logger.warning(f"Prefetch failed: {e}")
+
+    # Function to look up the semantic cache through the lookup coalescer
+    async def _lookup_cached(self, embedding, context: str):
+        """Enqueue the embedding and its context for the next batched cache lookup and wait for its response."""
+        if self.lookup_batcher is None:
+            self.pending_lookups = asyncio.Queue()
+            self.lookup_batcher = asyncio.create_task(self._drain_pending_lookups())
+        future = asyncio.get_running_loop().create_future()
+        await self.pending_lookups.put((embedding, context, future))
+        return await future
+
+    # Function to coalesce the pending cache lookups into a single matrix lookup
+    async def _drain_pending_lookups(self):
+        """Score the lookups queued while the previous batch ran together in one matrix lookup."""
+        while True:
+            batch = await _collect_batch(self.pending_lookups, self.config.concurrency_limit)
+            try:
+                responses = await asyncio.to_thread(
+                    self.semantic_cache.lookup_many,
+                    np.stack([embedding for embedding, _, _ in batch]),
+                    [context for _, context, _ in batch],
+                )
+            except Exception as e:
+                self.logger.warning(f"Semantic cache lookup failed: {e}")
+                responses = [None] * len(batch)
+            for (_, _, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    # Function to forward the partial responses of a turn to the event loop
+    def _publish_turn(self, loop, session_id: str, question: str, embedding, cache_context: str, documents: list,
+                      partial_responses: asyncio.Queue, cancelled: threading.Event):
+        """Iterate a turn in a worker thread and publish each partial response to its queue until it is cancelled."""
+        turn = self._stream_turn(session_id, question, embedding, cache_context, documents)
+        try:
+            for partial_response in turn:
+                if cancelled.is_set():
+                    self.logger.debug(f"{session_id} | Turn cancelled")
+                    break
+                loop.call_soon_threadsafe(partial_responses.put_nowait, partial_response)
+        except Exception as e:
+            self.logger.error(f"{session_id} | Turn failed: {e}")
+            loop.call_soon_threadsafe(partial_responses.put_nowait, e)
+        finally:
+            # Closing the generator closes the response stream of the turn
+            turn.close()
+            loop.call_soon_threadsafe(partial_responses.put_nowait, _TURN_DONE)
+
+    # Function to create a turn with the agent and yield its partial responses
+    def _stream_turn(self, session_id: str, question: str, embedding, cache_context: str = "", documents: list = None):
+        """Create a streaming turn for the question and yield the accumulated response."""
+
+        # The documents only supplement the retrieval: the replayed exchanges and the prefetched context are
+        # attached to the turn and the agent keeps its RAG tool, so a loosely similar prefetch cannot replace the knowledge search
+        turn_params = {}
+        if documents:
+            turn_params["documents"] = documents
 
         # Create a response stream from the agent
-        if self.stream:
-            response_stream = self.agent.create_turn(
-                session_id=self.session_id,
+        if self.config.stream:
+            response_stream = self.client.agents.turn.create(
+                agent_id=self.agent_id,
+                session_id=session_id,
                 messages=[
                     {
                         "role": "user", 
@@ -122,22 +568,53 @@ class AgenticProposalRH:
                     }
                 ],
                 stream=True,
+                **turn_params,
             )
 
         # Process the response stream and yield partial responses
-        partial_response = ""
-        for response in response_stream:
-            if hasattr(response, "error") and getattr(response, "error", None):
-
-                error_msg = getattr(response, "error", {}).get( "message", "Unknown error" )
-                self.logger.debug(f"Error: {error_msg}")
-                break
-            elif ( hasattr(response, "event") and getattr(response, "event", None)
-                and hasattr(response.event, "payload") and response.event.payload.event_type == "turn_complete" ):
-
-                partial_response += response.event.payload.turn.output_message.content
-                self.logger.debug(f"{self.session_id} | Response complete")
-                yield partial_response
+        state = {"chunks": [], "embedding": embedding, "question": question, "cache_context": cache_context, "session_id": session_id}
+        try:
+            for response in response_stream:
+                # Fast path: every regular chunk carries an event with a payload
+                try:
+                    payload = response.event.payload
+                    event_type = payload.event_type
+                except AttributeError:
+                    error = getattr(response, "error", None)
+                    if error:
+                        error_msg = error.get( "message", "Unknown error" )
+                        self.logger.debug(f"Error: {error_msg}")
+                        break
+                    continue
+
+                handler = self.event_handlers.get(event_type)
+                if handler:
+                    yield from handler(payload, state)
+        finally:
+            # Release the connection of the stream, also when the turn is cancelled before its end
+            response_stream.close()
+
+    # Function to yield the text deltas streamed while the turn progresses
+    def _on_step_progress(self, payload, state: dict):
+        """Append a text delta to the response so the UI renders tokens as they arrive."""
+        delta = payload.delta
+        if delta.type == "text" and delta.text:
+            state["chunks"].append(delta.text)
+            yield "".join(state["chunks"])
+
+    # Function to yield the final answer once the turn is complete
+    def _on_turn_complete(self, payload, state: dict):
+        """Replace the streamed deltas with the output message of the turn and cache it."""
+        response = payload.turn.output_message.content
+        state["chunks"] = [response]
+        self.logger.debug(f"{state['session_id']} | Response complete")
+        # The answer is already produced, a cache failure must not fail the turn
+        if state["embedding"] is not None:
+            try:
+                self.semantic_cache.insert(state["embedding"], response, question=state["question"], context=state["cache_context"])
+            except Exception as e:
+                self.logger.warning(f"{state['session_id']} | Response could not be cached: {e}")
+        yield response
 
 if __name__ == "__main__":
     # Create an instance of the agentic system
@@ -168,6 +645,7 @@ if __name__ == "__main__":
         theme=gradio.themes.Soft(primary_hue=gradio.themes.colors.red, secondary_hue=gradio.themes.colors.gray),
         flagging_mode="manual",
         flagging_options=["Like", "Spam", "Inappropriate", "Other"],
+        concurrency_limit=agenticSystem.config.concurrency_limit,
     )
     # Launch the chatbot UI
-    chatbot_ui.launch(server_name="0.0.0.0", server_port=7861, share=True, debug=True)
+    chatbot_ui.launch(server_name="0.0.0.0", server_port=7861, debug=True)
@@ -0,0 +1,363 @@
+# semantic_cache.py
+# This file implements a semantic cache for the chatbot responses.
+# Questions are matched by the cosine similarity of their embeddings, so repeated or
+# near-duplicate questions can be answered without a new RAG + LLM roundtrip.
+# When a directory is given the cache survives restarts: the embeddings live in a
+# memory-mapped file and the responses in a sqlite database.
+# Embeddings are stored quantized to int8 with one scale per vector, 4x smaller than float32.
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Minimum cosine similarity to consider two questions equivalent
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+# Maximum number of cached embeddings, the oldest ones are overwritten once it is reached
+DEFAULT_CAPACITY = 65536
+
+# Time to live of a cached response, in seconds (0 disables the expiration)
+DEFAULT_TTL_SECONDS = 86400.0
+
+# Number of rows widened to float32 at a time when scoring
+SCORE_BLOCK_ROWS = 4096
+
+# Number of stored rows under which the LSH cache scans every row, the exact scan is cheap at that size
+# and keeps the near-threshold matches that LSH misses
+LSH_MIN_ROWS = 10000
+
+# Files of a persistent cache
+EMBEDDINGS_FILE = "cache_emb.i8"
+SCALES_FILE = "cache_scale.f32"
+HEADER_FILE = "cache_emb.json"
+DATABASE_FILE = "cache.db"
+
+
+# Function to L2-normalize an embedding vector
+def normalize(embedding) -> np.ndarray:
+    """Return the embedding as a L2-normalized float32 vector."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0.0:
+        vector = vector / norm
+    return vector
+
+
+# Function to quantize an embedding vector to int8
+def quantize(embedding: np.ndarray):
+    """Return the embedding as int8 values in [-127, 127] and its float32 scale."""
+    scale = np.float32(np.max(np.abs(embedding)))
+    if scale == 0.0:
+        return np.zeros(embedding.shape, dtype=np.int8), scale
+    return np.rint(embedding * (127.0 / scale)).astype(np.int8), scale
+
+
+# Class to cache responses keyed by the embedding of the question
+class SemanticCache:
+    """Semantic cache of responses indexed by normalized question embeddings."""
+
+    # Function to initialize the cache, loading the persisted entries when a path is given
+    def __init__(self, threshold: float = DEFAULT_SIMILARITY_THRESHOLD, path: str = None,
+                 capacity: int = DEFAULT_CAPACITY, ttl: float = DEFAULT_TTL_SECONDS, model_id: str = None):
+        self.threshold = threshold
+        self.path = path
+        # Embedding model of the cached vectors, a persisted cache of another model is discarded
+        self.model_id = model_id
+        self.capacity = capacity
+        self.ttl = ttl
+        # Matrix (capacity, d) with one quantized embedding per row and their scales, allocated on the first insert
+        self.embeddings = None
+        self.scales = None
+        # Number of inserted entries, the next one is written at row count % capacity
+        self.count = 0
+        self.lock = threading.Lock()
+
+        try:
+            self._open()
+        except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+            # A read-only or broken directory must not stop the application, the cache then lives in memory
+            logger.warning(f"Semantic cache at {path} is not usable, keeping it in memory: {e}")
+            self.path = None
+            self.embeddings, self.scales, self.count = None, None, 0
+            self._clear_index()
+            self._open()
+
+    # Function to open the database and load the persisted entries
+    def _open(self):
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, DATABASE_FILE) if self.path else ":memory:", check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "idx INTEGER PRIMARY KEY, question TEXT, response TEXT, timestamp REAL, ttl REAL, context TEXT DEFAULT '')"
+        )
+        # Databases of an earlier version have no context column, their rows keep the empty context
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(responses)")]
+        if "context" not in columns:
+            self.db.execute("ALTER TABLE responses ADD COLUMN context TEXT DEFAULT ''")
+        self.db.commit()
+
+        if self.path and os.path.exists(os.path.join(self.path, HEADER_FILE)):
+            self._load()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Function to map the persisted embeddings, the OS page cache loads the pages on demand
+    def _load(self):
+        """Map the embeddings file described by the header file."""
+        with open(os.path.join(self.path, HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("model_id") != self.model_id:
+            logger.info(f"Semantic cache was built with embedding model {header.get('model_id')}, discarding it")
+            self._reset()
+            return
+        self.capacity = header["capacity"]
+        self.count = header["count"]
+        self.embeddings = np.memmap(os.path.join(self.path, EMBEDDINGS_FILE), dtype=np.int8,
+                                    mode="r+", shape=(self.capacity, header["dim"]))
+        self.scales = np.memmap(os.path.join(self.path, SCALES_FILE), dtype=np.float32,
+                                mode="r+", shape=(self.capacity,))
+        self._index_all()
+
+    # Function to drop every entry, in memory and on disk
+    def _reset(self):
+        """Empty the cache and remove its persisted embeddings."""
+        self.embeddings, self.scales, self.count = None, None, 0
+        self._clear_index()
+        self.db.execute("DELETE FROM responses")
+        self.db.commit()
+        if self.path:
+            for name in (HEADER_FILE, EMBEDDINGS_FILE, SCALES_FILE):
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+
+    # Function to allocate the embeddings matrix once the dimension is known
+    def _allocate(self, dim: int):
+        """Create the embeddings matrix, memory-mapped when the cache is persistent."""
+        if self.path:
+            try:
+                self.embeddings = np.memmap(os.path.join(self.path, EMBEDDINGS_FILE), dtype=np.int8,
+                                            mode="w+", shape=(self.capacity, dim))
+                self.scales = np.memmap(os.path.join(self.path, SCALES_FILE), dtype=np.float32,
+                                        mode="w+", shape=(self.capacity,))
+                return
+            except OSError as e:
+                logger.warning(f"Semantic cache embeddings cannot be written to {self.path}, keeping them in memory: {e}")
+                self.path = None
+        self.embeddings = np.zeros((self.capacity, dim), dtype=np.int8)
+        self.scales = np.zeros(self.capacity, dtype=np.float32)
+
+    # Function to persist the counter of entries
+    def _write_header(self):
+        """Flush the embeddings and atomically replace the header file."""
+        self.embeddings.flush()
+        self.scales.flush()
+        header_path = os.path.join(self.path, HEADER_FILE)
+        with open(header_path + ".tmp", "w") as f:
+            json.dump({
+                "model_id": self.model_id,
+                "capacity": self.capacity,
+                "count": self.count,
+                "dim": self.embeddings.shape[1],
+            }, f)
+        os.replace(header_path + ".tmp", header_path)
+
+    # Function to add a row to the index, the full scan needs no index
+    def _index(self, slot: int):
+        pass
+
+    # Function to remove a row from the index
+    def _unindex(self, slot: int):
+        pass
+
+    # Function to index every stored row after a load
+    def _index_all(self):
+        pass
+
+    # Function to empty the index
+    def _clear_index(self):
+        pass
+
+    # Function to compute the cosine similarity of quantized rows with a matrix of quantized queries
+    def _similarity(self, rows, queries: np.ndarray, query_scales: np.ndarray) -> np.ndarray:
+        """Dot the int8 rows (None for all rows) with the (B, d) int8 queries in one sgemm per block and rescale.
+
+        The rows are widened to float32 block by block, so the scan never holds more than SCORE_BLOCK_ROWS
+        float32 rows. The products of int8 values are exact in float32 up to d ~ 1040.
+        """
+        count = len(self) if rows is None else len(rows)
+        queries = queries.astype(np.float32).T
+        scores = np.empty((count, queries.shape[1]), dtype=np.float32)
+        for start in range(0, count, SCORE_BLOCK_ROWS):
+            block = slice(start, min(start + SCORE_BLOCK_ROWS, count))
+            selected = block if rows is None else rows[block]
+            scores[block] = (self.embeddings[selected].astype(np.float32) @ queries) * self.scales[selected, np.newaxis]
+        return scores * (query_scales / (127 * 127))
+
+    # Function to drop an entry, its zeroed embedding never matches again
+    def _evict(self, slot: int):
+        self._unindex(slot)
+        self.embeddings[slot] = 0
+        self.scales[slot] = 0.0
+        self.db.execute("DELETE FROM responses WHERE idx = ?", (slot,))
+
+    # Function to evict every expired entry
+    def _evict_expired(self):
+        """Evict the entries whose time to live is over."""
+        expired = self.db.execute(
+            "SELECT idx FROM responses WHERE ttl > 0 AND timestamp + ttl < ?", (time.time(),)
+        ).fetchall()
+        for (slot,) in expired:
+            self._evict(slot)
+
+    # Function to find the cached responses of a batch of questions at once
+    def lookup_many(self, embeddings: np.ndarray, contexts: list = None) -> list:
+        """Return the cached response (or None) for each row of a (B, d) matrix of normalized embeddings.
+
+        A response only matches when it was inserted with the same context as the question, the empty one by default.
+        """
+        contexts = contexts or [""] * len(embeddings)
+        with self.lock:
+            if self.embeddings is None or len(self) == 0 or embeddings.shape[1] != self.embeddings.shape[1]:
+                return [None] * len(embeddings)
+            rows = self._candidate_rows(embeddings)
+            if rows is not None and len(rows) == 0:
+                return [None] * len(embeddings)
+
+            # The whole batch is scored at once against the int8 rows, with the queries quantized the same way
+            quantized = [quantize(embedding) for embedding in embeddings]
+            queries = np.stack([values for values, _ in quantized])
+            query_scales = np.array([scale for _, scale in quantized], dtype=np.float32)
+            scores = self._similarity(rows, queries, query_scales)
+
+            responses = []
+            for column, context in enumerate(contexts):
+                # The most similar rows are tried first, the ones stored in another context are skipped
+                matches = np.flatnonzero(scores[:, column] >= self.threshold)
+                response = None
+                for row in matches[np.argsort(scores[matches, column])[::-1]]:
+                    response = self._response(int(rows[row]) if rows is not None else int(row), context)
+                    if response is not None:
+                        break
+                responses.append(response)
+            return responses
+
+    # Function to compute the candidate rows of a batch of embeddings, the full scan uses every row
+    def _candidate_rows(self, embeddings: np.ndarray):
+        return None
+
+    # Function to read the response stored in a row, evicting it when it has expired
+    def _response(self, slot: int, context: str = ""):
+        """Return the response of the row, or None when it was evicted, has expired or belongs to another context."""
+        entry = self.db.execute(
+            "SELECT response, timestamp, ttl, context FROM responses WHERE idx = ?", (slot,)
+        ).fetchone()
+        if entry is None or entry[3] != context:
+            return None
+        response, timestamp, ttl, _ = entry
+        if ttl > 0 and timestamp + ttl < time.time():
+            self._evict(slot)
+            self.db.commit()
+            return None
+        return response
+
+    # Function to store the response of a new question
+    def insert(self, embedding: np.ndarray, response: str, question: str = "", context: str = ""):
+        """Store a normalized embedding and its response for a context, overwriting the oldest entry when full."""
+        with self.lock:
+            if self.embeddings is not None and embedding.shape[0] != self.embeddings.shape[1]:
+                logger.info("Semantic cache embedding dimension changed, discarding the cache")
+                self._reset()
+            if self.embeddings is None:
+                self._allocate(embedding.shape[0])
+            slot = self.count % self.capacity
+            if self.count >= self.capacity:
+                self._unindex(slot)
+            self.embeddings[slot], self.scales[slot] = quantize(embedding)
+            self._index(slot)
+            self.count += 1
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (idx, question, response, timestamp, ttl, context) VALUES (?, ?, ?, ?, ?, ?)",
+                (slot, question, response, time.time(), self.ttl, context),
+            )
+            self._evict_expired()
+            self.db.commit()
+            if self.path:
+                self._write_header()
+
+
+# Class to cache responses with a random-projection LSH index over the embeddings
+class LSHSemanticCache(SemanticCache):
+    """Semantic cache with sub-linear approximate lookups through random-projection LSH once it grows."""
+
+    # Function to initialize the cache and its empty hash tables
+    def __init__(self, threshold: float = DEFAULT_SIMILARITY_THRESHOLD, path: str = None,
+                 capacity: int = DEFAULT_CAPACITY, ttl: float = DEFAULT_TTL_SECONDS, model_id: str = None,
+                 num_hyperplanes: int = 16, num_tables: int = 8, seed: int = 0, min_rows: int = LSH_MIN_ROWS):
+        self.num_hyperplanes = num_hyperplanes
+        self.num_tables = num_tables
+        # The tables are kept up to date from the first row, but only used once the cache holds min_rows rows
+        self.min_rows = min_rows
+        # Hyperplanes (L, k, d) are drawn from a fixed seed, so every start hashes the rows the same way
+        self.seed = seed
+        self.hyperplanes = None
+        # One table per set of hyperplanes, mapping a bucket key to row ids
+        self.tables = [{} for _ in range(num_tables)]
+        super().__init__(threshold=threshold, path=path, capacity=capacity, ttl=ttl, model_id=model_id)
+
+    # Function to get the hyperplanes of the embedding dimension
+    def _hyperplanes(self, dim: int) -> np.ndarray:
+        if self.hyperplanes is None:
+            rng = np.random.default_rng(self.seed)
+            self.hyperplanes = rng.standard_normal((self.num_tables, self.num_hyperplanes, dim), dtype=np.float32)
+        return self.hyperplanes
+
+    # Function to compute the bucket key of an embedding in every table
+    def _hash(self, embedding: np.ndarray) -> list:
+        """Return the packed sign bits of the embedding for each of the L tables."""
+        bits = (self._hyperplanes(embedding.shape[0]) @ embedding) > 0
+        return [row.tobytes() for row in np.packbits(bits, axis=1)]
+
+    # Function to index every stored row, hashing them block by block with one matmul per block
+    def _index_all(self):
+        """Rebuild the tables from the stored rows, which reads the embeddings file once."""
+        hyperplanes = self._hyperplanes(self.embeddings.shape[1]).reshape(self.num_tables * self.num_hyperplanes, -1)
+        for start in range(0, len(self), SCORE_BLOCK_ROWS):
+            block = self.embeddings[start:min(start + SCORE_BLOCK_ROWS, len(self))].astype(np.float32)
+            bits = (block @ hyperplanes.T) > 0
+            keys = np.packbits(bits.reshape(len(block), self.num_tables, self.num_hyperplanes), axis=2)
+            for offset, row_keys in enumerate(keys):
+                for table, key in zip(self.tables, row_keys):
+                    table.setdefault(key.tobytes(), set()).add(start + offset)
+
+    # Function to empty the tables, the hyperplanes follow the dimension of the next rows
+    def _clear_index(self):
+        self.hyperplanes = None
+        self.tables = [{} for _ in range(self.num_tables)]
+
+    # Function to add a row to every table
+    def _index(self, slot: int):
+        for table, key in zip(self.tables, self._hash(self.embeddings[slot])):
+            table.setdefault(key, set()).add(slot)
+
+    # Function to remove a row from every table
+    def _unindex(self, slot: int):
+        for table, key in zip(self.tables, self._hash(self.embeddings[slot])):
+            table.get(key, set()).discard(slot)
+
+    # Function to compute the union of the rows sharing a bucket with any of the embeddings
+    def _candidate_rows(self, embeddings: np.ndarray):
+        if len(self) < self.min_rows:
+            return None
+        candidates = set()
+        for embedding in embeddings:
+            for table, key in zip(self.tables, self._hash(embedding)):
+                candidates.update(table.get(key, ()))
+        return np.fromiter(candidates, dtype=np.intp, count=len(candidates))
@@ -0,0 +1,120 @@
+# test_semantic_cache.py
+# This file tests the semantic cache, in memory and persisted to a temporary directory.
+import numpy as np
+import pytest
+import semantic_cache
+from semantic_cache import LSHSemanticCache, SemanticCache, normalize
+
+DIM = 32
+
+
+# Function to draw distinct random normalized embeddings
+def _embeddings(count: int, dim: int = DIM, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.stack([normalize(row) for row in rng.standard_normal((count, dim))])
+
+
+@pytest.mark.parametrize("cache_class", [SemanticCache, LSHSemanticCache])
+def test_lookup_on_partially_filled_cache(cache_class):
+    cache = cache_class(capacity=16)
+    hit, miss = _embeddings(2)
+    cache.insert(hit, "answer")
+    assert cache.lookup_many(np.stack([hit, miss])) == ["answer", None]
+
+
+def test_lookup_on_empty_cache_and_other_dimension():
+    cache = SemanticCache(capacity=16)
+    assert cache.lookup_many(_embeddings(2)) == [None, None]
+    cache.insert(_embeddings(1)[0], "answer")
+    assert cache.lookup_many(_embeddings(1, dim=DIM + 1)) == [None]
+
+
+def test_lookup_requires_the_same_context():
+    cache = SemanticCache(capacity=16)
+    embedding = _embeddings(1)[0]
+    cache.insert(embedding, "first question", context="")
+    cache.insert(embedding, "follow-up", context="previous")
+    queries = np.stack([embedding] * 3)
+    assert cache.lookup_many(queries, ["", "previous", "other"]) == ["first question", "follow-up", None]
+
+
+def test_ring_buffer_overwrites_the_oldest_entry():
+    cache = SemanticCache(capacity=2)
+    embeddings = _embeddings(3)
+    for index, embedding in enumerate(embeddings):
+        cache.insert(embedding, f"answer {index}")
+    assert len(cache) == 2
+    assert cache.lookup_many(embeddings) == [None, "answer 1", "answer 2"]
+
+
+@pytest.mark.parametrize("cache_class", [SemanticCache, LSHSemanticCache])
+def test_entries_survive_a_reload(tmp_path, cache_class):
+    embeddings = _embeddings(3)
+    cache = cache_class(path=str(tmp_path), capacity=16, model_id="model")
+    for index, embedding in enumerate(embeddings):
+        cache.insert(embedding, f"answer {index}")
+
+    reloaded = cache_class(path=str(tmp_path), capacity=16, model_id="model")
+    assert len(reloaded) == 3
+    assert reloaded.lookup_many(embeddings) == ["answer 0", "answer 1", "answer 2"]
+
+
+def test_model_change_discards_the_persisted_entries(tmp_path):
+    embedding = _embeddings(1)[0]
+    SemanticCache(path=str(tmp_path), capacity=16, model_id="old").insert(embedding, "answer")
+
+    cache = SemanticCache(path=str(tmp_path), capacity=16, model_id="new")
+    assert len(cache) == 0
+    assert cache.lookup_many(embedding[np.newaxis]) == [None]
+
+
+def test_dimension_change_discards_the_entries():
+    cache = SemanticCache(capacity=16)
+    cache.insert(_embeddings(1)[0], "old answer")
+    embedding = _embeddings(1, dim=DIM * 2)[0]
+    cache.insert(embedding, "new answer")
+    assert len(cache) == 1
+    assert cache.lookup_many(embedding[np.newaxis]) == ["new answer"]
+
+
+def test_expired_entries_are_evicted(monkeypatch):
+    cache = SemanticCache(capacity=16, ttl=10.0)
+    embedding = _embeddings(1)[0]
+    cache.insert(embedding, "answer")
+
+    now = semantic_cache.time.time()
+    monkeypatch.setattr(semantic_cache.time, "time", lambda: now + 11.0)
+    assert cache.lookup_many(embedding[np.newaxis]) == [None]
+    assert not cache.scales.any()
+
+
+def test_unusable_directory_falls_back_to_memory(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("not a directory")
+    cache = SemanticCache(path=str(path), capacity=16)
+    assert cache.path is None
+    embedding = _embeddings(1)[0]
+    cache.insert(embedding, "answer")
+    assert cache.lookup_many(embedding[np.newaxis]) == ["answer"]
+
+
+def test_lsh_tables_are_rebuilt_on_reload(tmp_path):
+    embeddings = _embeddings(32)
+    cache = LSHSemanticCache(path=str(tmp_path), capacity=64, model_id="model", min_rows=0)
+    for index, embedding in enumerate(embeddings):
+        cache.insert(embedding, f"answer {index}")
+
+    reloaded = LSHSemanticCache(path=str(tmp_path), capacity=64, model_id="model", min_rows=0)
+    assert [{key: set(rows) for key, rows in table.items()} for table in reloaded.tables] == \
+        [{key: set(rows) for key, rows in table.items() if rows} for table in cache.tables]
+    assert reloaded.lookup_many(embeddings) == [f"answer {index}" for index in range(32)]
+
+
+def test_lsh_scans_every_row_below_the_minimum():
+    cache = LSHSemanticCache(capacity=16, min_rows=4)
+    embeddings = _embeddings(4)
+    for index, embedding in enumerate(embeddings[:3]):
+        cache.insert(embedding, f"answer {index}")
+    assert cache._candidate_rows(embeddings) is None
+    cache.insert(embeddings[3], "answer 3")
+    assert cache._candidate_rows(embeddings) is not None